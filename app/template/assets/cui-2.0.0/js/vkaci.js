@@ -3,6 +3,10 @@ var server_user = "";
 var server_password = "";
 var asnPresent = true;
 
+// Read the generation of the graph published by the server once per query, the queries then
+// match it as gen with an equality so that neo4j uses the (name, generation) indexes
+const generation_prefix = "MATCH (g:Publication) WITH g.generation AS gen "
+
 function neo_viz_config(showPodName, container, cypher, seed = null) {
     var podCaption = showPodName ? "name" : "pod";
 
@@ -11,7 +15,7 @@ function neo_viz_config(showPodName, container, cypher, seed = null) {
         server_url: server_url,
         server_user: server_user,
         server_password: server_password,
-        initial_cypher: cypher,
+        initial_cypher: generation_prefix + cypher,
         fix_nodes_in_place_on_drag: true,
         layout: {
             improvedLayout: true,
@@ -191,6 +195,19 @@ selectedNamespace = ".*"
 const selectedLabelFilters = new Map()
 selectedPodNamespace = "!"
 
+function generation_filter(v) {
+    // Only match the generation of the graph published by the server, gen is bound by generation_prefix
+    return `${v}.generation = gen`
+}
+
+function ns_filter(pod) {
+    // Compare the namespace with an equality so that neo4j uses the Pod.ns index
+    if (selectedNamespace == ".*") {
+        return `${pod}.ns IS NOT NULL AND ${generation_filter(pod)}`
+    }
+    return `${pod}.ns = '${selectedNamespace}' AND ${generation_filter(pod)}`
+}
+
 function getLabelFilterString() {
     const lbls = [];
     selectedLabelFilters.forEach((value) => lbls.push(`'${value}'`));
@@ -210,11 +227,11 @@ function addLabelQuery() {
 
 function draw_all() {
     selectedView = View.All
-    let q = `OPTIONAL MATCH (p:Pod)-[r:RUNNING_ON_SEC]->(n:Node)-[r1:RUNNING_IN]->(v:VM_Host)-  [r2:CONNECTED_TO_SEC]->(a) WHERE p.ns =~ '${selectedNamespace}'
-            OPTIONAL MATCH (p1:Pod)-[r3:RUNNING_ON_SEC]->(n1:Node)-[r4:CONNECTED_TO_SEC]->(b) WHERE p1.ns =~ '${selectedNamespace}'
-            OPTIONAL MATCH (p2:Pod)-[r5:RUNNING_ON_TER]->(n2:Node)-[r6:RUNNING_IN]->(v1:VM_Host)-[r7:CONNECTED_TO_TER]->(c) WHERE p2.ns =~ '${selectedNamespace}'
-            OPTIONAL MATCH (p3:Pod)-[r8:RUNNING_ON_TER]->(n3:Node)-[r9:CONNECTED_TO_TER]->(d) WHERE p3.ns =~ '${selectedNamespace}'
-            OPTIONAL MATCH (p4:Pod)-[r10]->(n4:Node)-[r11*1..2]->(e) WHERE p4.ns =~ '${selectedNamespace}' AND (NOT TYPE(r10) IN ['RUNNING_ON_SEC', 'RUNNING_ON_TER']) AND NONE(rel IN r11 WHERE TYPE(rel) IN ['CONNECTED_TO_SEC', 'CONNECTED_TO_TER'])`
+    let q = `OPTIONAL MATCH (p:Pod)-[r:RUNNING_ON_SEC]->(n:Node)-[r1:RUNNING_IN]->(v:VM_Host)-  [r2:CONNECTED_TO_SEC]->(a) WHERE ${ns_filter("p")}
+            OPTIONAL MATCH (p1:Pod)-[r3:RUNNING_ON_SEC]->(n1:Node)-[r4:CONNECTED_TO_SEC]->(b) WHERE ${ns_filter("p1")}
+            OPTIONAL MATCH (p2:Pod)-[r5:RUNNING_ON_TER]->(n2:Node)-[r6:RUNNING_IN]->(v1:VM_Host)-[r7:CONNECTED_TO_TER]->(c) WHERE ${ns_filter("p2")}
+            OPTIONAL MATCH (p3:Pod)-[r8:RUNNING_ON_TER]->(n3:Node)-[r9:CONNECTED_TO_TER]->(d) WHERE ${ns_filter("p3")}
+            OPTIONAL MATCH (p4:Pod)-[r10]->(n4:Node)-[r11*1..2]->(e) WHERE ${ns_filter("p4")} AND (NOT TYPE(r10) IN ['RUNNING_ON_SEC', 'RUNNING_ON_TER']) AND NONE(rel IN r11 WHERE TYPE(rel) IN ['CONNECTED_TO_SEC', 'CONNECTED_TO_TER'])`
     q += addLabelQuery();
     q += `RETURN *`
     draw(q)
@@ -223,11 +240,11 @@ function draw_all() {
 
 function draw_without_pods() {
     selectedView = View.WithoutPods
-    let q = `OPTIONAL MATCH (p:Pod)-[r:RUNNING_ON_SEC]->(n:Node)-[r1:RUNNING_IN]->(v:VM_Host)-  [r2:CONNECTED_TO_SEC]->(a) WHERE p.ns =~ '${selectedNamespace}'
-            OPTIONAL MATCH (p1:Pod)-[r3:RUNNING_ON_SEC]->(n1:Node)-[r4:CONNECTED_TO_SEC]->(b) WHERE p1.ns =~ '${selectedNamespace}'
-            OPTIONAL MATCH (p2:Pod)-[r5:RUNNING_ON_TER]->(n2:Node)-[r6:RUNNING_IN]->(v1:VM_Host)-[r7:CONNECTED_TO_TER]->(c) WHERE p2.ns =~ '${selectedNamespace}'
-            OPTIONAL MATCH (p3:Pod)-[r8:RUNNING_ON_TER]->(n3:Node)-[r9:CONNECTED_TO_TER]->(d) WHERE p3.ns =~ '${selectedNamespace}'
-            OPTIONAL MATCH (p4:Pod)-[r10]->(n4:Node)-[r11*1..2]->(e) WHERE p4.ns =~ '${selectedNamespace}' AND (NOT TYPE(r10) IN ['RUNNING_ON_SEC', 'RUNNING_ON_TER']) AND NONE(rel IN r11 WHERE TYPE(rel) IN ['CONNECTED_TO_SEC', 'CONNECTED_TO_TER'])`
+    let q = `OPTIONAL MATCH (p:Pod)-[r:RUNNING_ON_SEC]->(n:Node)-[r1:RUNNING_IN]->(v:VM_Host)-  [r2:CONNECTED_TO_SEC]->(a) WHERE ${ns_filter("p")}
+            OPTIONAL MATCH (p1:Pod)-[r3:RUNNING_ON_SEC]->(n1:Node)-[r4:CONNECTED_TO_SEC]->(b) WHERE ${ns_filter("p1")}
+            OPTIONAL MATCH (p2:Pod)-[r5:RUNNING_ON_TER]->(n2:Node)-[r6:RUNNING_IN]->(v1:VM_Host)-[r7:CONNECTED_TO_TER]->(c) WHERE ${ns_filter("p2")}
+            OPTIONAL MATCH (p3:Pod)-[r8:RUNNING_ON_TER]->(n3:Node)-[r9:CONNECTED_TO_TER]->(d) WHERE ${ns_filter("p3")}
+            OPTIONAL MATCH (p4:Pod)-[r10]->(n4:Node)-[r11*1..2]->(e) WHERE ${ns_filter("p4")} AND (NOT TYPE(r10) IN ['RUNNING_ON_SEC', 'RUNNING_ON_TER']) AND NONE(rel IN r11 WHERE TYPE(rel) IN ['CONNECTED_TO_SEC', 'CONNECTED_TO_TER'])`
     q += addLabelQuery();
     q += `RETURN n, r1, v, r2, a, n1, r4, b, n2, r6, v1, r7, c, n3, r9, d, n4, r11, e`
     draw(q)
@@ -236,7 +253,7 @@ function draw_without_pods() {
 
 function draw_without_bgp_peers() {
     selectedView = View.WithoutBgpPeers
-    let q = ` MATCH (p:Pod)-[r]->(m:Node)-[u:RUNNING_IN]-(v:VM_Host)-[r1:CONNECTED_TO]-(s:Switch) WHERE p.ns =~ '${selectedNamespace}' `
+    let q = ` MATCH (p:Pod)-[r]->(m:Node)-[u:RUNNING_IN]-(v:VM_Host)-[r1:CONNECTED_TO]-(s:Switch) WHERE ${ns_filter("p")} `
     q += addLabelQuery();
     q += `RETURN u, r1, m, v,s`
     draw(q)
@@ -245,7 +262,7 @@ function draw_without_bgp_peers() {
 
 function draw_pods_and_nodes() {
     selectedView = View.PodsAndNodes
-    let q = ` MATCH (p:Pod)-[r1]->(n:Node) WHERE p.ns =~ '${selectedNamespace}' `
+    let q = ` MATCH (p:Pod)-[r1]->(n:Node) WHERE ${ns_filter("p")} `
     q += addLabelQuery();
     q += `RETURN p,r1,n`
     draw(q, true)
@@ -254,7 +271,7 @@ function draw_pods_and_nodes() {
 
 function draw_only_bgp_peers() {
     selectedView = View.OnlyBgpPeers
-    let q = ` MATCH (p:Pod)-->(n:Node)-[r:PEERED_INTO]->(s:Switch) WHERE p.ns =~ '${selectedNamespace}' `
+    let q = ` MATCH (p:Pod)-->(n:Node)-[r:PEERED_INTO]->(s:Switch) WHERE ${ns_filter("p")} `
     q += addLabelQuery();
     q += `RETURN r, n,s`
     draw(q)
@@ -264,8 +281,8 @@ function draw_only_bgp_peers() {
 
 function draw_only_primary_links() {
     selectedView = View.OnlyPrimarylinks
-    let q = `OPTIONAL MATCH (p:Pod)-[r:RUNNING_ON]->(n:Node)-[r1:CONNECTED_TO]->(a) WHERE p.ns =~ '${selectedNamespace}'
-            OPTIONAL MATCH (p1:Pod)-[r2:RUNNING_ON]->(n1:Node)-[r3:RUNNING_IN]->(v:VM_Host)-[r4:CONNECTED_TO]-(b) WHERE p1.ns =~ '${selectedNamespace}'`
+    let q = `OPTIONAL MATCH (p:Pod)-[r:RUNNING_ON]->(n:Node)-[r1:CONNECTED_TO]->(a) WHERE ${ns_filter("p")}
+            OPTIONAL MATCH (p1:Pod)-[r2:RUNNING_ON]->(n1:Node)-[r3:RUNNING_IN]->(v:VM_Host)-[r4:CONNECTED_TO]-(b) WHERE ${ns_filter("p1")}`
     q += addLabelQuery();
     q += `RETURN p, p1, n, n1, r, r2, r1, r3, r4, v, a, b`
     draw(q, true)
@@ -273,8 +290,8 @@ function draw_only_primary_links() {
 
 function draw_only_sriov_links() {
     selectedView = View.OnlySriovlinks
-    let q = `OPTIONAl MATCH (p:Pod)-[r:RUNNING_ON_SEC]->(n:Node)-[r1:CONNECTED_TO_SEC]->(a) WHERE p.ns =~ '${selectedNamespace}'
-            OPTIONAL MATCH (p1:Pod)-[r2:RUNNING_ON_SEC]->(n1:Node)-[r3:RUNNING_IN]->(v:VM_Host)-[r4:CONNECTED_TO_SEC]->(b) WHERE p1.ns =~ '${selectedNamespace}'`
+    let q = `OPTIONAl MATCH (p:Pod)-[r:RUNNING_ON_SEC]->(n:Node)-[r1:CONNECTED_TO_SEC]->(a) WHERE ${ns_filter("p")}
+            OPTIONAL MATCH (p1:Pod)-[r2:RUNNING_ON_SEC]->(n1:Node)-[r3:RUNNING_IN]->(v:VM_Host)-[r4:CONNECTED_TO_SEC]->(b) WHERE ${ns_filter("p1")}`
     q += addLabelQuery();
     q += `RETURN p, p1, n, n1, r, r2, r1, r3, r4, v, a, b`
     draw(q, true)
@@ -282,8 +299,8 @@ function draw_only_sriov_links() {
 
 function draw_only_macvlan_links() {
     selectedView = View.OnlyMacvlanlinks
-    let q = `OPTIONAL MATCH (p:Pod)-[r:RUNNING_ON_TER]->(n:Node)-[r1:CONNECTED_TO_TER]->(a) WHERE p.ns =~ '${selectedNamespace}'
-            OPTIONAL MATCH (p1:Pod)-[r2:RUNNING_ON_TER]->(n1:Node)-[r3:RUNNING_IN]->(v:VM_Host)-[r4:CONNECTED_TO_TER]->(b) WHERE p1.ns =~ '${selectedNamespace}'`
+    let q = `OPTIONAL MATCH (p:Pod)-[r:RUNNING_ON_TER]->(n:Node)-[r1:CONNECTED_TO_TER]->(a) WHERE ${ns_filter("p")}
+            OPTIONAL MATCH (p1:Pod)-[r2:RUNNING_ON_TER]->(n1:Node)-[r3:RUNNING_IN]->(v:VM_Host)-[r4:CONNECTED_TO_TER]->(b) WHERE ${ns_filter("p1")}`
     q += addLabelQuery();
     q += `RETURN p, p1, n, n1, r, r2, r1, r3, r4, v, a, b`
     draw(q, true)
@@ -339,7 +356,7 @@ function draw_leaf() {
     var str = $("#leafname").val();
     if (!str.trim()) return;
     var seed = "0.8455348811333163:1645676676633"
-    var config_leaf = neo_viz_config(true, "viz_leaf", 'MATCH (s:Switch)<-[r]-(m) WHERE s.name= "' + str + '" RETURN *', seed)
+    var config_leaf = neo_viz_config(true, "viz_leaf", 'MATCH (s:Switch)<-[r]-(m) WHERE s.name= "' + str + '" AND ' + generation_filter("s") + ' RETURN *', seed)
     var viz_leaf = new NeoVis.default(config_leaf);
     viz_leaf.render();
     // Get seed method: This number is printed when you use getSeed in order for the objects within a certain view to not overlap each ther everytime you click show 
@@ -356,15 +373,15 @@ function draw_node() {
     if (asnPresent) {
         var q = `MATCH (p:Pod)-[r]->(n:Node)-[r2]->(s:Switch)
             MATCH (n)-[r3:PEERED_INTO]->(s1)
-            WHERE n.name = "${str}"
+            WHERE n.name = "${str}" AND ${generation_filter("n")}
             RETURN *
         `;
     } else {
-        var q = `OPTIONAL MATCH (p:Pod)-[r:RUNNING_ON_SEC]->(n:Node)-[r1:RUNNING_IN]->(v:VM_Host)-      [r2:CONNECTED_TO_SEC]->(a) WHERE n.name = "${str}"
-            OPTIONAL MATCH (p1:Pod)-[r3:RUNNING_ON_SEC]->(n1:Node)-[r4:CONNECTED_TO_SEC]->(b) WHERE n1.name = "${str}"
-            OPTIONAL MATCH (p2:Pod)-[r5:RUNNING_ON_TER]->(n2:Node)-[r6:RUNNING_IN]->(v1:VM_Host)-[r7:CONNECTED_TO_TER]->(c) WHERE n2.name = "${str}"
-            OPTIONAL MATCH (p3:Pod)-[r8:RUNNING_ON_TER]->(n3:Node)-[r9:CONNECTED_TO_TER]->(d) WHERE n3.name = "${str}"
-            OPTIONAL MATCH (p4:Pod)-[r10]->(n4:Node)-[r11*1..2]->(e) WHERE n4.name = "${str}" AND (NOT TYPE(r10) IN ['RUNNING_ON_SEC', 'RUNNING_ON_TER']) AND NONE(rel IN r11 WHERE TYPE(rel) IN ['CONNECTED_TO_SEC', 'CONNECTED_TO_TER'])
+        var q = `OPTIONAL MATCH (p:Pod)-[r:RUNNING_ON_SEC]->(n:Node)-[r1:RUNNING_IN]->(v:VM_Host)-      [r2:CONNECTED_TO_SEC]->(a) WHERE n.name = "${str}" AND ${generation_filter("n")}
+            OPTIONAL MATCH (p1:Pod)-[r3:RUNNING_ON_SEC]->(n1:Node)-[r4:CONNECTED_TO_SEC]->(b) WHERE n1.name = "${str}" AND ${generation_filter("n1")}
+            OPTIONAL MATCH (p2:Pod)-[r5:RUNNING_ON_TER]->(n2:Node)-[r6:RUNNING_IN]->(v1:VM_Host)-[r7:CONNECTED_TO_TER]->(c) WHERE n2.name = "${str}" AND ${generation_filter("n2")}
+            OPTIONAL MATCH (p3:Pod)-[r8:RUNNING_ON_TER]->(n3:Node)-[r9:CONNECTED_TO_TER]->(d) WHERE n3.name = "${str}" AND ${generation_filter("n3")}
+            OPTIONAL MATCH (p4:Pod)-[r10]->(n4:Node)-[r11*1..2]->(e) WHERE n4.name = "${str}" AND ${generation_filter("n4")} AND (NOT TYPE(r10) IN ['RUNNING_ON_SEC', 'RUNNING_ON_TER']) AND NONE(rel IN r11 WHERE TYPE(rel) IN ['CONNECTED_TO_SEC', 'CONNECTED_TO_TER'])
             RETURN *
         `;
     }
@@ -389,15 +406,15 @@ function draw_pod() {
     if (asnPresent) {
         var p = `MATCH (p:Pod)-[r]->(n:Node)-[r2]->(s:Switch)
             MATCH (n)-[r3:PEERED_INTO]->(s1)
-            WHERE p.${t} = "${str}"
+            WHERE p.${t} = "${str}" AND ${generation_filter("p")}
             RETURN *
         `;
     } else {
-        var p = `OPTIONAL MATCH (p:Pod)-[r:RUNNING_ON_SEC]->(n:Node)-[r1:RUNNING_IN]->(v:VM_Host)-      [r2:CONNECTED_TO_SEC]->(a) WHERE p.${t} = "${str}"
-            OPTIONAL MATCH (p1:Pod)-[r3:RUNNING_ON_SEC]->(n1:Node)-[r4:CONNECTED_TO_SEC]->(b) WHERE p1.${t} = "${str}"
-            OPTIONAL MATCH (p2:Pod)-[r5:RUNNING_ON_TER]->(n2:Node)-[r6:RUNNING_IN]->(v1:VM_Host)-[r7:CONNECTED_TO_TER]->(c) WHERE p2.${t} = "${str}"
-            OPTIONAL MATCH (p3:Pod)-[r8:RUNNING_ON_TER]->(n3:Node)-[r9:CONNECTED_TO_TER]->(d) WHERE p3.${t} = "${str}"
-            OPTIONAL MATCH (p4:Pod)-[r10]->(n4:Node)-[r11*1..2]->(e) WHERE p4.${t} = "${str}" AND (NOT TYPE(r10) IN ['RUNNING_ON_SEC', 'RUNNING_ON_TER']) AND NONE(rel IN r11 WHERE TYPE(rel) IN ['CONNECTED_TO_SEC', 'CONNECTED_TO_TER'])
+        var p = `OPTIONAL MATCH (p:Pod)-[r:RUNNING_ON_SEC]->(n:Node)-[r1:RUNNING_IN]->(v:VM_Host)-      [r2:CONNECTED_TO_SEC]->(a) WHERE p.${t} = "${str}" AND ${generation_filter("p")}
+            OPTIONAL MATCH (p1:Pod)-[r3:RUNNING_ON_SEC]->(n1:Node)-[r4:CONNECTED_TO_SEC]->(b) WHERE p1.${t} = "${str}" AND ${generation_filter("p1")}
+            OPTIONAL MATCH (p2:Pod)-[r5:RUNNING_ON_TER]->(n2:Node)-[r6:RUNNING_IN]->(v1:VM_Host)-[r7:CONNECTED_TO_TER]->(c) WHERE p2.${t} = "${str}" AND ${generation_filter("p2")}
+            OPTIONAL MATCH (p3:Pod)-[r8:RUNNING_ON_TER]->(n3:Node)-[r9:CONNECTED_TO_TER]->(d) WHERE p3.${t} = "${str}" AND ${generation_filter("p3")}
+            OPTIONAL MATCH (p4:Pod)-[r10]->(n4:Node)-[r11*1..2]->(e) WHERE p4.${t} = "${str}" AND ${generation_filter("p4")} AND (NOT TYPE(r10) IN ['RUNNING_ON_SEC', 'RUNNING_ON_TER']) AND NONE(rel IN r11 WHERE TYPE(rel) IN ['CONNECTED_TO_SEC', 'CONNECTED_TO_TER'])
             RETURN *
         `;
     }
@@ -1,6 +1,6 @@
 #!/usr/local/bin/python3
-from flask import Flask, render_template, request, redirect
-from  graph import VkaciTable, VkaciGraph, VkaciBuilTopology, VkaciEnvVariables, ApicMethodsResolve
+from flask import Flask, render_template, request, redirect, abort
+from  graph import VkaciTable, VkaciGraph, VkaciBuilTopology, VkaciEnvVariables, ApicMethodsResolve, VkaciRefreshScheduler
 
 
 app = Flask(__name__, template_folder='template',static_folder='template/assets')
@@ -8,18 +8,25 @@ env = VkaciEnvVariables()
 topology = VkaciBuilTopology(env, ApicMethodsResolve())
 graph = VkaciGraph(env,topology)
 table = VkaciTable(topology)
+scheduler = VkaciRefreshScheduler(graph, topology, env.refresh_interval)
 
 f = open("version.txt", "r")
 __build__ = f.read()
 
-graph.update_database()
+# The first topology is built in the background, the UI shows a loading page until it is published
+scheduler.start()
+scheduler.request(reason="startup")
 
 @app.route('/')
 def index():
-    return render_template('index.html', version=__build__, env=env, pod_names=topology.get_pods(), 
-    node_names=topology.get_nodes(), namespaces=topology.get_namespaces(), 
-    leaf_names=topology.get_leafs(), label_names=topology.get_labels(),
-    asnPresent=topology.asnPresent, sriov=topology.sriov, macvlan=topology.macvlan)
+    # Render the whole page from the same published topology
+    snapshot = topology.get_snapshot()
+    if snapshot.version == 0:
+        return render_template('loading.html', job=scheduler.get_status())
+    return render_template('index.html', version=__build__, env=env, pod_names=topology.get_pods(snapshot=snapshot), 
+    node_names=topology.get_nodes(snapshot), namespaces=topology.get_namespaces(snapshot), 
+    leaf_names=topology.get_leafs(snapshot), label_names=topology.get_labels(snapshot),
+    asnPresent=snapshot.asnPresent, sriov=snapshot.sriov, macvlan=snapshot.macvlan)
 
 
 @app.route('/pod_names')
@@ -65,9 +72,34 @@ def table_data_services():
 @app.route('/re-generate',methods=['GET', 'POST'])
 def regenerate():
     if request.method == 'POST':
-        # Update neo4j with topology data using graph
-        graph.update_database()
+        # The refresh runs in the background, a forced regenerate drops the cached ACI information
+        job = scheduler.request(force=request.values.get("force", "").casefold() == "true")
+        if request.accept_mimetypes.best == "application/json":
+            return job, 202
     return redirect("/", code=302)
 
+@app.route('/healthz')
+def healthz():
+    return {"status": "ok"}
+
+@app.route('/readyz')
+def readyz():
+    snapshot = topology.get_snapshot()
+    if snapshot.version == 0:
+        return {"ready": False, "version": snapshot.version}, 503
+    return {"ready": True, "version": snapshot.version}
+
+@app.route('/job_status')
+def job_status():
+    job_id = request.args.get("id", type=int)
+    job = scheduler.get_status(job_id)
+    if job is None:
+        abort(404)
+    return job
+
+@app.route('/cache_stats')
+def cache_stats():
+    return topology.get_cache_stats()
+
 if __name__ == '__main__':
 	app.run(debug=False, host="0.0.0.0", port=8080)
\ No newline at end of file
@@ -1,9 +1,16 @@
 import unittest
 import json
+import requests
+import time
+import threading
+import os
+import tempfile
 from pyaci import Node, core
 from unittest.mock import patch, MagicMock
 from kubernetes import client
-from app.graph import ApicMethodsResolve, VkaciBuilTopology, VkaciEnvVariables, VkaciTable
+from kubernetes.client.rest import ApiException
+from py2neo.errors import TransientError, ClientError, ConnectionBroken
+from app.graph import ApicMethodsResolve, VkaciBuilTopology, VkaciEnvVariables, VkaciTable, VkaciK8sCache, VkaciTokenBucket, VkaciTTLCache, VkaciRefreshScheduler, VkaciGraph, VkaciTimeoutAdapter
 
 core.aciClassMetas = {"topRoot": {
     "properties": {}, "rnFormat": "something"}}
@@ -185,6 +192,7 @@ def create_lldp_neighbour(on: bool = True, desc: bool = True):
             n.lldpAdjEp[0].sysDesc = "VMware version 123"
         n.sysDesc = n.dn = "topology/pod-1/node-204"
         n.id = "eth1/1"
+        n.portDesc = "pathA"
     return n
 
 
@@ -199,6 +207,7 @@ def create_cdp_neighbour(on: bool = False):
         n.cdpAdjEp[0].ver = "Cisco version 123"
         n.sysDesc = n.dn = "topology/pod-1/node-203"
         n.id = "eth1/1"
+        n.locDesc = "pathA"
     return n
 
 
@@ -217,6 +226,7 @@ def create_bgpPeer():
     b = Expando()
     b.operSt = "established"
     b.dn = "topology/pod-1/node-204"
+    b.addr = "192.168.1.2"
     return b
 
 def create_nextHop(route:str, next_hop:str, tag = "56001"):
@@ -248,16 +258,30 @@ class ApicMethodsMock(ApicMethodsResolve):
     def get_fvcep_mac(self, apic: Node, mac: str):
         return self.eps[0]
 
+    def get_fvcep_paths(self, apic: Node, macs: list, chunk_size: int = 50):
+        return {ep.mac: ep for ep in self.eps if ep.mac in macs}
+
     def get_lldpif(self, apic: Node, pathDn):
         return self.lldps
 
     def get_cdpif(self, apic: Node, pathDn):
         return self.cdpns
 
+    def get_all_lldpif(self, apic: Node):
+        return self.lldps
+
+    def get_all_cdpif(self, apic: Node):
+        return self.cdpns
+
     def get_bgppeerentry(self, apic: Node, vrf: str, node_ip: str):
         return self.bgpPeers
 
-    def get_all_nexthops(self, apic:Node, dn:str):
+    def get_vrf_bgppeerentries(self, apic: Node, vrf: str):
+        return self.bgpPeers
+
+    def get_all_nexthops(self, apic:Node, dn:str, page:int = 0, page_size:int = 0):
+        if page_size > 0:
+            return self.nextHops[page * page_size:(page + 1) * page_size]
         return self.nextHops
     
     def path_fixup(self, apic:Node, path):
@@ -548,6 +572,21 @@ class TestVkaciGraph(unittest.TestCase):
         self.assertDictEqual(result, expected)
 
 
+    def test_bgp_table_service_snapshot(self):
+        """Test that the service of a prefix is found in the snapshot the table is built from"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        table = VkaciTable(build)
+        build.update()
+        snapshot = build.get_snapshot()
+        # Act
+        with patch.object(build, 'list_services', MagicMock(return_value=[])):
+            build.update()
+        # Assert
+        self.assertEqual(table.get_svc_name("192.168.5.1", snapshot), ("appx", "example service"))
+        self.assertEqual(table.get_svc_name("192.168.5.1"), ("", ""))
+
     def test_node_table(self):
         """Test that a node table is correctly created"""
         # Arrange
@@ -605,6 +644,7 @@ class TestVkaciGraph(unittest.TestCase):
         
         # Assert
         self.assertDictEqual(result, expected)
+        self.assertNotIn('data', build.get_snapshot().topology['services']['appx'][0])
 
 
     def assert_cluster_as(self, expected):
@@ -621,7 +661,7 @@ class TestVkaciGraph(unittest.TestCase):
         self.assert_cluster_as('56001')
 
 
-    @patch('kubernetes.client.CoreV1Api.read_namespaced_pod', MagicMock(return_value=pods[1]))
+    @patch('kubernetes.client.CoreV1Api.list_namespaced_pod', MagicMock(return_value=client.V1PodList(api_version="1", items=[pods[1]])))
     def test_kube_router_bgp_as_detection(self):
         """Test that the bgp AS is detected with kube-router"""
         with patch('app.graph.VkaciBuilTopology.get_calico_custom_object', MagicMock(return_value={})):
@@ -636,7 +676,7 @@ class TestVkaciGraph(unittest.TestCase):
             {"spec": {"virtualRouters": [{'localASN': 56003}]}}
         ]
     }
-    @patch('kubernetes.client.CoreV1Api.read_namespaced_pod', MagicMock(return_value=None))
+    @patch('kubernetes.client.CoreV1Api.list_namespaced_pod', MagicMock(return_value=client.V1PodList(api_version="1", items=[])))
     @patch('app.graph.VkaciBuilTopology.list_cilium_custom_objects', MagicMock(return_value=cilium_policies))
     def test_cilium_bgp_as_detection(self):
         """Test that the bgp AS is detected with cilium"""
@@ -652,7 +692,7 @@ class TestVkaciGraph(unittest.TestCase):
             {"spec": {"virtualRouters": [{'localASN': 56005}]}}
         ]
     }
-    @patch('kubernetes.client.CoreV1Api.read_namespaced_pod', MagicMock(return_value=None))
+    @patch('kubernetes.client.CoreV1Api.list_namespaced_pod', MagicMock(return_value=client.V1PodList(api_version="1", items=[])))
     @patch('app.graph.VkaciBuilTopology.list_cilium_custom_objects', MagicMock(return_value=invalid_cilium_policies))
     def test_invalid_cilium_bgp_as_detection(self):
         """Test that the bgp AS is not detected with invalid cilium config"""
@@ -660,7 +700,7 @@ class TestVkaciGraph(unittest.TestCase):
             self.assert_cluster_as(None)
 
 
-    @patch('kubernetes.client.CoreV1Api.read_namespaced_pod', MagicMock(return_value=None))
+    @patch('kubernetes.client.CoreV1Api.list_namespaced_pod', MagicMock(return_value=client.V1PodList(api_version="1", items=[])))
     @patch('app.graph.VkaciBuilTopology.list_cilium_custom_objects', MagicMock(return_value=[]))
     def test_invalid_as_detection(self):
         """Test that the bgp AS is not detected with no valid config"""
@@ -1032,5 +1072,887 @@ class TestVkaciGraph(unittest.TestCase):
                 self.assertDictEqual(result, expected)
                 self.assertEqual(build.aci_vrf, "uni/tn-Ciscolive/ctx-vrf-01")
 
+    def test_bulk_path_resolution(self):
+        """Test that the node paths are resolved in chunks and not with one query per node"""
+        # Arrange
+        apic = MagicMock()
+        apic.methods.ResolveClass.return_value.GET.side_effect = [
+            [MockMo("10.0.0.1", "MAC1", "pathA"), MockMo("10.0.0.2", "MAC2", "pathB")],
+            [MockMo("10.0.0.3", "MAC3", "pathC")]
+        ]
+        mock = ApicMethodsMock()
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), mock)
+        # Act
+        paths = ApicMethodsResolve().get_fvcep_paths(apic, ["MAC1", "MAC2", "MAC3"], 2)
+        with patch.object(mock, 'get_fvcep_mac', MagicMock(return_value=ApicMethodsMock.mo1)) as get_fvcep_mac:
+            result = build.update()
+        # Assert
+        self.assertEqual(apic.methods.ResolveClass.return_value.GET.call_count, 2)
+        self.assertEqual(sorted(paths.keys()), ["MAC1", "MAC2", "MAC3"])
+        self.assertEqual(paths["MAC3"].fvRsCEpToPathEp[0].tDn, "pathC")
+        get_fvcep_mac.assert_not_called()
+        self.assertEqual(result['nodes']['1234abc']['neighbours']['esxi4.cam.ciscolabs.com']['switches'], {'leaf-204': {'vmxnic1-eth1/1'}})
+
+    def test_bulk_adjacency(self):
+        """Test that the LLDP/CDP neighbours are read from the fabric wide snapshot"""
+        # Arrange
+        env = dict(self.vars)
+        env["APIC_BULK_ADJACENCY"] = "true"
+        mock = ApicMethodsMock()
+        mock.lldps = [create_lldp_neighbour(False)]
+        mock.cdpns = [create_cdp_neighbour(True)]
+        mock.lldps[0].portDesc = "pathA"
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(env), mock)
+        # Act
+        with patch.object(mock, 'get_lldpif', MagicMock()) as get_lldpif, patch.object(mock, 'get_cdpif', MagicMock()) as get_cdpif:
+            result = build.update()
+        # Assert
+        get_lldpif.assert_not_called()
+        get_cdpif.assert_not_called()
+        self.assertEqual(result['nodes']['1234abc']['neighbours'], {'CiscoLabs5': {'Description': 'Cisco version 123', 'switches': {'leaf-203': {'vmxnic2-eth1/1'}}}})
+
+    def test_vrf_bgp_peers(self):
+        """Test that the BGP peers are loaded once for the VRF and matched by node IP"""
+        # Arrange
+        mock = ApicMethodsMock()
+        other_peer = create_bgpPeer()
+        other_peer.addr = "192.168.1.99"
+        other_peer.dn = "topology/pod-1/node-205"
+        mock.bgpPeers = [create_bgpPeer(), other_peer]
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), mock)
+        # Act
+        with patch.object(mock, 'get_vrf_bgppeerentries', wraps=mock.get_vrf_bgppeerentries) as get_vrf_bgppeerentries, \
+                patch.object(mock, 'get_bgppeerentry', MagicMock()) as get_bgppeerentry:
+            result = build.update()
+        # Assert
+        get_vrf_bgppeerentries.assert_called_once()
+        self.assertIn(get_vrf_bgppeerentries.call_args.args[0], build.apic_pool.apics.values())
+        self.assertEqual(get_vrf_bgppeerentries.call_args.args[1], '.*/dom-Ciscolive:vrf-01/.*')
+        get_bgppeerentry.assert_not_called()
+        self.assertEqual(result['nodes']['1234abc']['bgp_peers'], {'leaf-204': {'prefix_count': 2}})
+
+    def test_node_mac_resolution(self):
+        """Test that the node mac is found among many endpoints and unresolved nodes are reported"""
+        # Arrange
+        mock = ApicMethodsMock()
+        mock.eps = [MockMo("10.0.0." + str(i), "OTHERMAC" + str(i), "pathB") for i in range(10)] + [ApicMethodsMock.mo1]
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), mock)
+        unresolved_mock = ApicMethodsMock()
+        unresolved_mock.eps = mock.eps[:-1]
+        unresolved = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), unresolved_mock)
+        # Act
+        result = build.update()
+        with self.assertLogs('app.graph', level='ERROR') as logs:
+            unresolved_result = unresolved.update()
+        # Assert
+        self.assertEqual(result['nodes']['1234abc']['mac'], 'MOCKMO1C')
+        self.assertNotIn('mac', unresolved_result['nodes']['1234abc'])
+        self.assertEqual(unresolved_result['nodes']['1234abc']['neighbours'], {})
+        self.assertTrue(any("Could not resolve the mac address of 1 nodes: 1234abc (192.168.1.2)" in l for l in logs.output))
+
+    def test_paged_pod_list(self):
+        """Test that the Pods are loaded page by page from the raw JSON"""
+        # Arrange
+        raw_pods = [client.ApiClient().sanitize_for_serialization(p) for p in pods]
+        pages = [
+            {"items": raw_pods[:2], "metadata": {"continue": "next"}},
+            {"items": raw_pods[2:], "metadata": {}}
+        ]
+        responses = []
+        for page in pages:
+            resp = MagicMock()
+            resp.data = json.dumps(page).encode()
+            responses.append(resp)
+        env = dict(self.vars)
+        env["K8S_PAGE_SIZE"] = "2"
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(env), ApicMethodsMock())
+        reference = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        # Act
+        with patch('kubernetes.client.CoreV1Api.list_pod_for_all_namespaces', MagicMock(side_effect=responses)) as list_pods:
+            result = build.update()
+        expected = reference.update()
+        # Assert
+        self.assertEqual(list_pods.call_count, 2)
+        self.assertEqual(list_pods.call_args_list[1].kwargs['_continue'], "next")
+        self.assertEqual(list_pods.call_args_list[1].kwargs['limit'], 2)
+        self.assertDictEqual(result, expected)
+
+    @patch('app.graph.VkaciK8sCache.watch', MagicMock(return_value=None))
+    def test_k8s_watch_cache(self):
+        """Test that in watch mode only the nodes that changed are updated from ACI"""
+        # Arrange
+        env = dict(self.vars)
+        env["K8S_WATCH"] = "true"
+        mock = ApicMethodsMock()
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(env), mock)
+        down_peer = create_bgpPeer()
+        down_peer.operSt = "idle"
+        new_peer = create_bgpPeer()
+        new_peer.dn = "topology/pod-1/node-205"
+        # Act
+        with patch.object(build, 'update_node', wraps=build.update_node) as update_node:
+            first = build.update()
+            first_calls = update_node.call_count
+            build.k8s_cache.apply('pods', 'DELETED', pods[0])
+            mock.bgpPeers = [down_peer, new_peer]
+            second = build.update()
+            second_calls = update_node.call_count - first_calls
+            build.k8s_cache.apply('nodes', 'MODIFIED', client.V1Node(
+                metadata=client.V1ObjectMeta(name="1234abc", labels={"app": "redis"}),
+                status=client.V1NodeStatus(addresses=[client.V1NodeAddress(address="192.168.1.2", type="InternalIP")])))
+            third = build.update()
+            third_calls = update_node.call_count - first_calls - second_calls
+        # Assert
+        self.assertEqual(first_calls, 1)
+        self.assertEqual(second_calls, 0)
+        self.assertEqual(third_calls, 1)
+        self.assertNotIn('dateformat', second['nodes']['1234abc']['pods'])
+        self.assertEqual(second['nodes']['1234abc']['neighbours'], first['nodes']['1234abc']['neighbours'])
+        self.assertEqual(first['nodes']['1234abc']['bgp_peers'], {'leaf-204': {'prefix_count': 2}})
+        self.assertEqual(second['nodes']['1234abc']['bgp_peers'], {'leaf-205': {'prefix_count': 0}})
+        self.assertEqual(third['nodes']['1234abc']['mac'], 'MOCKMO1C')
+
+    def test_k8s_watch_relist_failure(self):
+        """Test that a failed relist does not stop the watch and the resources are listed from K8s meanwhile"""
+        # Arrange
+        env = dict(self.vars)
+        env["K8S_WATCH"] = "true"
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(env), ApicMethodsMock())
+        cache = build.k8s_cache
+        with patch('app.graph.VkaciK8sCache.watch', MagicMock(return_value=None)):
+            cache.start()
+        cache.list_funcs['pods'] = MagicMock(side_effect=[ApiException(status=500), client.V1PodList(api_version="1", items=pods), ApiException(status=500)])
+        class Stop(Exception):
+            pass
+        # Act
+        cache.synced['pods'] = False
+        live = build.list_pods()
+        with patch('kubernetes.watch.Watch.stream', MagicMock(side_effect=ApiException(status=410))), \
+             patch('app.graph.time.sleep', MagicMock(side_effect=[None, Stop()])):
+            with self.assertRaises(Stop):
+                VkaciK8sCache.watch(cache, 'pods')
+        # Assert
+        self.assertEqual(len(list(live)), len(pods))
+        self.assertEqual(cache.list_funcs['pods'].call_count, 3)
+        self.assertIsNone(cache.get('pods'))
+        self.assertIsNotNone(cache.get('nodes'))
+
+    def test_apic_session_pool(self):
+        """Test that the APIC sessions are reused across refreshes and rebuilt on failure"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        failing = MagicMock(side_effect=[requests.exceptions.ConnectionError("reset"), "ok"])
+        failing.__name__ = "failing"
+        # Act
+        first_apics = build.apic_pool.get(build.env.apic_ip)
+        apics = build.apic_pool.get(build.env.apic_ip)
+        result = build.apic_pool.run(failing)
+        # Assert
+        self.assertEqual(len(apics), 2)
+        self.assertIs(first_apics[0], apics[0])
+        self.assertEqual(result, "ok")
+        self.assertIs(failing.call_args_list[0].args[0], apics[0])
+        self.assertIs(failing.call_args_list[1].args[0], apics[1])
+        self.assertIsNot(build.apic_pool.get(build.env.apic_ip)[0], apics[0])
+
+    def test_apic_scheduler(self):
+        """Test that the queries go to the least loaded healthy APIC"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        apics = build.apic_pool.get(build.env.apic_ip)
+        stats = build.apic_pool.stats
+        # Act
+        stats['192.168.25.192']['latency']['node'] = 2.0
+        stats['192.168.1.2']['latency']['node'] = 0.5
+        stats['192.168.1.2']['latency']['bulk'] = 30.0
+        slow_first = build.apic_pool.pick()
+        bulk_first = build.apic_pool.pick(kind='bulk')
+        stats['192.168.1.2']['in_flight'] = 10
+        busy_second = build.apic_pool.pick()
+        stats['192.168.25.192']['down_until'] = time.monotonic() + 30
+        failed_first = build.apic_pool.pick()
+        stats['192.168.1.2']['down_until'] = time.monotonic() + 30
+        all_failed = build.apic_pool.pick()
+        # Assert
+        self.assertEqual(slow_first, '192.168.1.2')
+        self.assertEqual(bulk_first, '192.168.25.192')
+        self.assertEqual(build.apic_pool.method_class(ApicMethodsMock().get_fvcep), 'bulk')
+        self.assertEqual(build.apic_pool.method_class(ApicMethodsMock().path_fixup), 'node')
+        self.assertEqual(busy_second, '192.168.25.192')
+        self.assertEqual(failed_first, '192.168.1.2')
+        self.assertEqual(all_failed, '192.168.25.192')
+        self.assertEqual(len(apics), 2)
+
+    def test_apic_reconnect(self):
+        """Test that the other APICs are scheduled while a failing APIC is reconnected"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        build.apic_pool.get(build.env.apic_ip)
+        connecting = threading.Event()
+        release = threading.Event()
+        def connect(ip):
+            connecting.set()
+            release.wait(5)
+            return MagicMock()
+        # Act
+        with patch.object(build.apic_pool, 'connect', connect):
+            thread = threading.Thread(target=build.apic_pool.fail, args=('192.168.25.192',))
+            thread.start()
+            connecting.wait(5)
+            picked = build.apic_pool.pick()
+            release.set()
+            thread.join(5)
+        # Assert
+        self.assertEqual(picked, '192.168.1.2')
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(build.apic_pool.stats['192.168.25.192']['failures'], 1)
+
+    def test_apic_hedging(self):
+        """Test that a slow APIC query is duplicated to another APIC and the first answer is used"""
+        # Arrange
+        env = dict(self.vars)
+        env["APIC_HEDGE_PERCENTILE"] = "90"
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(env), ApicMethodsMock())
+        apics = build.apic_pool.get(build.env.apic_ip)
+        def slow_first(apic):
+            if apic is apics[0]:
+                time.sleep(0.5)
+                return "slow"
+            return "fast"
+        def get_fvcep(apic):
+            return slow_first(apic)
+        build.apic_pool.latencies['slow_first'] = [0.01] * 20
+        build.apic_pool.latencies['get_fvcep'] = [0.01] * 20
+        # Act
+        result = build.apic_pool.run(slow_first)
+        stats = build.apic_pool.get_hedge_stats(reset=True)
+        bulk_result = build.apic_pool.run(get_fvcep)
+        bulk_stats = build.apic_pool.get_hedge_stats()
+        # Assert
+        self.assertEqual(result, "fast")
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['hedged'], 1)
+        self.assertEqual(stats['wins'], 1)
+        self.assertEqual(stats['hedge_rate'], 1)
+        self.assertIn(bulk_result, ["slow", "fast"])
+        self.assertEqual(bulk_stats['requests'], 0)
+        self.assertIsNone(build.apic_pool.hedge_delay(get_fvcep))
+
+    def test_node_outcomes(self):
+        """Test that a node that fails is published without the ACI information"""
+        # Arrange
+        mock = ApicMethodsMock()
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), mock)
+        # Act
+        with patch.object(mock, 'path_fixup', MagicMock(side_effect=Exception("APIC error"))):
+            result = build.update()
+        # Assert
+        self.assertEqual(result['nodes']['1234abc']['neighbours'], {})
+        self.assertEqual(result['nodes']['1234abc']['bgp_peers'], {})
+        self.assertEqual(build.node_outcomes['1234abc']['status'], 'error')
+        self.assertEqual(build.node_outcomes['1234abc']['error'], 'APIC error')
+
+    def test_node_timeout(self):
+        """Test that a node that does not complete in time does not block the refresh"""
+        # Arrange
+        env = dict(self.vars)
+        env["NODE_TIMEOUT"] = "1"
+        mock = ApicMethodsMock()
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(env), mock)
+        def slow_path_fixup(apic, path):
+            time.sleep(3)
+            return path
+        # Act
+        start = time.monotonic()
+        with patch.object(mock, 'path_fixup', MagicMock(side_effect=slow_path_fixup)):
+            result = build.update()
+        duration = time.monotonic() - start
+        # Assert
+        self.assertLess(duration, 3)
+        self.assertEqual(build.node_outcomes['1234abc']['status'], 'timeout')
+        self.assertEqual(result['nodes']['1234abc']['neighbours'], {})
+
+    def test_node_task_older_refresh(self):
+        """Test that a node task of an older refresh does not record anything in the current refresh"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        nodes = {'1234abc': {'node_ip': '192.168.1.2', 'mac': 'mac', 'neighbours': {}, 'bgp_peers': {}}}
+        build.start_nodes(nodes)
+        older = build.refresh_id
+        build.start_nodes(nodes)
+        # Act
+        with patch.object(build, 'update_node') as update_node:
+            work = build.update_node_task(older, '1234abc', nodes['1234abc'], None)
+        # Assert
+        self.assertIsNone(work)
+        update_node.assert_not_called()
+        self.assertIsNone(build.node_outcomes['1234abc']['started'])
+
+    def test_apic_request_timeout(self):
+        """Test that the APIC requests get a default timeout"""
+        # Arrange
+        adapter = VkaciTimeoutAdapter(5)
+        # Act
+        with patch.object(requests.adapters.HTTPAdapter, 'send') as send:
+            adapter.send(MagicMock())
+            adapter.send(MagicMock(), timeout=1)
+        # Assert
+        self.assertEqual(send.call_args_list[0].kwargs['timeout'], 5)
+        self.assertEqual(send.call_args_list[1].kwargs['timeout'], 1)
+
+    def test_apic_rate_limit(self):
+        """Test that the queries to an APIC are rate limited"""
+        # Arrange
+        bucket = VkaciTokenBucket(10, 1)
+        # Act
+        start = time.monotonic()
+        for i in range(4):
+            bucket.acquire()
+        duration = time.monotonic() - start
+        # Assert
+        self.assertGreaterEqual(duration, 0.25)
+
+    def test_concurrent_collection(self):
+        """Test that the K8s and APIC collection tasks run at the same time"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        barrier = threading.Barrier(2, timeout=5)
+        def together(func):
+            def wait(*args):
+                barrier.wait()
+                return func(*args)
+            return wait
+        # Act
+        with patch.object(build, 'list_nodes', together(build.list_nodes)), \
+             patch.object(build, 'get_bgp_peers', together(build.get_bgp_peers)):
+            result = build.update()
+        # Assert
+        self.assertFalse(barrier.broken)
+        self.assertIn('1234abc', result['nodes'])
+
+    def test_collection_skips_bgp_without_as(self):
+        """Test that the BGP routes are not collected when no cluster AS is detected"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        # Act
+        with patch.object(build, 'detect_cluster_as', MagicMock(return_value=None)), \
+             patch.object(build, 'collect_bgp_info') as collect_bgp_info:
+            build.update()
+        # Assert
+        collect_bgp_info.assert_not_called()
+        self.assertFalse(build.asnPresent)
+
+    def test_collection_error(self):
+        """Test that a failed collection task is logged and fails the refresh"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        # Act
+        with patch.object(build, 'collect_bgp_info', MagicMock(side_effect=requests.exceptions.ConnectionError("down"))), \
+             self.assertLogs('app.graph', level='ERROR') as logs, \
+             self.assertRaises(requests.exceptions.ConnectionError):
+            build.update()
+        # Assert
+        self.assertIn("Collection task bgp failed: down", "\n".join(logs.output))
+        self.assertEqual(build.get_snapshot().version, 0)
+
+    def test_paged_nfna_list(self):
+        """Test that the NodeFabricNetworkAttachments are loaded page by page and grouped by node"""
+        # Arrange
+        other_node = {"spec": {"aciTopology": {"ens1f3": {"fabricLink": ["abc/def/node-102/[eth1/4]"], "pods": []}},
+            "nodeName": "otherNode", "networkRef": {"name": "sriov-net2"}, "primaryCni": "sriov"}, "metadata": {"name": "other"}}
+        pages = [
+            {"items": nfna["items"][:1], "metadata": {"continue": "next"}},
+            {"items": nfna["items"][1:] + [other_node], "metadata": {}}
+        ]
+        env = dict(self.vars)
+        env["K8S_PAGE_SIZE"] = "1000"
+        paged = VkaciBuilTopology(
+            VkaciEnvVariables(env), ApicMethodsMock())
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        reference = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        # Act
+        with patch('kubernetes.client.CustomObjectsApi.list_namespaced_custom_object', MagicMock(side_effect=pages)) as list_nfna:
+            cr = paged.list_nfna()
+        with patch('kubernetes.client.CustomObjectsApi.list_namespaced_custom_object', MagicMock(return_value=cr)):
+            result = build.update()
+        expected = reference.update()
+        # Assert
+        self.assertEqual(list_nfna.call_count, 2)
+        self.assertEqual(list_nfna.call_args_list[1].kwargs['_continue'], "next")
+        self.assertEqual(list_nfna.call_args_list[1].kwargs['limit'], 1000)
+        self.assertEqual(cr["items"], nfna["items"] + [other_node])
+        self.assertDictEqual(result, expected)
+
+    def test_paged_bgp_routes(self):
+        """Test that the route table is read page by page and matched to the K8s nodes by IP"""
+        # Arrange
+        mock = ApicMethodsMock()
+        env = dict(self.vars)
+        env["APIC_PAGE_SIZE"] = "2"
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(env), mock)
+        reference = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        # Act
+        with patch.object(mock, 'get_all_nexthops', wraps=mock.get_all_nexthops) as get_all_nexthops:
+            build.update()
+        reference.update()
+        # Assert
+        self.assertEqual(get_all_nexthops.call_count, 2)
+        self.assertEqual(get_all_nexthops.call_args_list[1].args[2:], (1, 2))
+        self.assertDictEqual(build.get_bgp_info(), reference.get_bgp_info())
+        self.assertIn({"ip": "192.168.1.2", "hostname": "1234abc", "image": "node.svg"},
+            build.get_bgp_info()['leaf-204']['192.168.5.1/32']['hosts'])
+
+    def test_path_cache(self):
+        """Test that path_fixup is cached across refreshes until the cache is invalidated"""
+        # Arrange
+        mock = ApicMethodsMock()
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), mock)
+        # Act
+        with patch.object(mock, 'path_fixup', wraps=mock.path_fixup) as path_fixup:
+            first = build.update()
+            second = build.update()
+            cached_calls = path_fixup.call_count
+            build.invalidate()
+            build.update()
+        # Assert
+        self.assertEqual(cached_calls, 1)
+        self.assertEqual(path_fixup.call_count, 2)
+        self.assertDictEqual(first, second)
+        self.assertEqual(build.get_cache_stats()['path_fixup'], {'hits': 1, 'misses': 2, 'size': 1})
+
+    def test_ttl_cache(self):
+        """Test that the cache entries expire and the least recently used are evicted"""
+        # Arrange
+        cache = VkaciTTLCache(2, 1)
+        loader = MagicMock(side_effect=lambda key: key.upper())
+        # Act
+        cache.get("a", loader)
+        cache.get("b", loader)
+        cache.get("a", loader)
+        cache.get("c", loader)
+        cache.get("a", loader)
+        cache.get("b", loader)
+        with patch('app.graph.time.monotonic', MagicMock(return_value=time.monotonic() + 2)):
+            expired = cache.get("b", loader)
+        # Assert
+        self.assertEqual(expired, "B")
+        self.assertEqual([c.args[0] for c in loader.call_args_list], ["a", "b", "c", "b", "b"])
+        self.assertEqual(cache.get_stats(), {'hits': 2, 'misses': 5, 'size': 2})
+
+    def test_fabric_inventory(self):
+        """Test that the fabric nodes are loaded once, reloaded for unknown next hops and saved for warm starts"""
+        # Arrange
+        mock = ApicMethodsMock()
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(self.vars)
+            env["FABRIC_INVENTORY_FILE"] = os.path.join(tmp, "inventory.json")
+            build = VkaciBuilTopology(
+                VkaciEnvVariables(env), mock)
+            # Act
+            with patch.object(mock, 'get_overlay_ip_to_switch_map', wraps=mock.get_overlay_ip_to_switch_map) as get_overlay_ip_to_switch_map:
+                build.update()
+                build.update()
+                loads = get_overlay_ip_to_switch_map.call_count
+                build.fabric_inventory.updated -= 600
+                mock.nextHops = mock.nextHops + [create_nextHop("192.168.6.1/32", "192.168.2.6")]
+                build.update()
+                restarted = VkaciBuilTopology(
+                    VkaciEnvVariables(env), mock)
+                restarted.update()
+        # Assert
+        self.assertEqual(loads, 1)
+        self.assertEqual(get_overlay_ip_to_switch_map.call_count, 2)
+        self.assertEqual(restarted.get_cache_stats()['fabric_inventory']['refreshes'], 0)
+        self.assertEqual(restarted.get_bgp_info()['leaf-204']['192.168.5.1/32']['hosts'][0],
+            {"ip": "192.168.2.5", "hostname": "leaf 203", "image": "switch.png"})
+
+    def test_next_hop_node_without_pods(self):
+        """Test that a next hop on a K8s node without pods does not reload the fabric inventory"""
+        # Arrange
+        mock = ApicMethodsMock()
+        mock.nextHops = mock.nextHops + [create_nextHop("192.168.6.1/32", "192.168.1.9")]
+        idle_node = client.V1Node(
+            metadata=client.V1ObjectMeta(name="idle-node"),
+            status=client.V1NodeStatus(addresses=[client.V1NodeAddress(address="192.168.1.9", type="InternalIP")]))
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), mock)
+        # Act
+        with patch('kubernetes.client.CoreV1Api.list_node', MagicMock(return_value=client.V1NodeList(api_version="1", items=nodes + [idle_node]))), \
+             patch.object(mock, 'get_overlay_ip_to_switch_map', wraps=mock.get_overlay_ip_to_switch_map) as get_overlay_ip_to_switch_map:
+            build.update()
+            build.fabric_inventory.updated -= 600
+            build.update()
+        # Assert
+        # The next hop is not a fabric node and the inventory was old enough to be reloaded on a miss
+        self.assertNotIn("192.168.1.9", build.fabric_inventory.nodes)
+        self.assertGreater(time.time() - build.fabric_inventory.updated, build.fabric_inventory.miss_interval)
+        self.assertEqual(get_overlay_ip_to_switch_map.call_count, 1)
+        self.assertEqual(build.get_cache_stats()['fabric_inventory']['refreshes'], 1)
+        self.assertEqual(build.get_bgp_info()['leaf-204']['192.168.6.1/32']['hosts'][0],
+            {"ip": "192.168.1.9", "hostname": "idle-node", "image": "node.svg"})
+
+    def test_cluster_as_cache(self):
+        """Test that the cluster AS is detected once with the CNI and detected again after an invalidation"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        # Act
+        with patch('app.graph.VkaciBuilTopology.get_calico_custom_object', MagicMock(return_value={'spec': {'asNumber': 56001}})) as calico:
+            build.update()
+            build.update()
+            cached_calls = calico.call_count
+            cni = build.get_cache_stats()['cni']
+            build.invalidate()
+            build.update()
+        # Assert
+        self.assertEqual(cached_calls, 1)
+        self.assertEqual(calico.call_count, 2)
+        self.assertEqual(cni, {'cni': 'calico', 'asn': '56001'})
+        self.assertEqual(build.get_cluster_as(), '56001')
+
+    def test_cluster_as_cache_ttl(self):
+        """Test that without watch the cluster AS is detected again once the cache expires, with watch it is kept"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        watched = VkaciBuilTopology(
+            VkaciEnvVariables({**self.vars, "K8S_WATCH": "true"}), ApicMethodsMock())
+        # Act
+        with patch('app.graph.VkaciBuilTopology.get_calico_custom_object', MagicMock(return_value={'spec': {'asNumber': 56001}})) as calico, \
+                patch.object(watched, 'start_cni_watch', MagicMock()):
+            build.detect_cluster_as()
+            build.detect_cluster_as()
+            cached_calls = calico.call_count
+            build.cni_detected -= build.env.cni_cache_ttl
+            build.detect_cluster_as()
+            expired_calls = calico.call_count
+            watched.detect_cluster_as()
+            watched.cni_detected -= watched.env.cni_cache_ttl
+            watched.detect_cluster_as()
+        # Assert
+        self.assertEqual(build.env.cni_cache_ttl, 300)
+        self.assertEqual(cached_calls, 1)
+        self.assertEqual(expired_calls, 2)
+        self.assertEqual(calico.call_count, 3)
+        self.assertEqual(watched.get_cache_stats()['cni'], {'cni': 'calico', 'asn': '56001'})
+
+    def test_kube_router_label_selector(self):
+        """Test that kube-router is found with a label selector"""
+        # Arrange
+        env = dict(self.vars)
+        env["KUBE_ROUTER_LABEL_SELECTOR"] = "app=kube-router"
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(env), ApicMethodsMock())
+        # Act
+        with patch('app.graph.VkaciBuilTopology.get_calico_custom_object', MagicMock(return_value={})), \
+                patch('kubernetes.client.CoreV1Api.list_namespaced_pod', MagicMock(return_value=client.V1PodList(api_version="1", items=[pods[1]]))) as list_pods:
+            asn = build.detect_cluster_as()
+        # Assert
+        self.assertEqual(asn, '56002')
+        self.assertEqual(build.cni['cni'], 'kube-router')
+        list_pods.assert_called_once_with('kube-system', label_selector="app=kube-router", limit=1)
+
+    def test_topology_snapshot(self):
+        """Test that readers keep seeing the published topology while a refresh builds the next one"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        first = build.update()
+        first_snapshot = build.get_snapshot()
+        seen = []
+        def read_while_building(*args):
+            seen.append((build.get_snapshot().version, build.get_nodes(), build.get_pods()))
+            return {}
+        # Act
+        with patch.object(build, 'list_nfna', MagicMock(side_effect=read_while_building)):
+            second = build.update()
+        # Assert
+        self.assertEqual(first_snapshot.version, 1)
+        self.assertEqual(build.get_snapshot().version, 2)
+        self.assertEqual(seen, [(1, ['1234abc'], ['dateformat', 'kube-router-xfgr', 'macvlan-pod', 'sriov-pod'])])
+        self.assertIs(first_snapshot.topology, first)
+        self.assertIs(build.get(), second)
+        self.assertIsNot(first, second)
+
+    def test_refresh_scheduler(self):
+        """Test that concurrent regenerate requests are merged and the job progress is reported"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        graph = MagicMock()
+        scheduler = VkaciRefreshScheduler(graph, build)
+        running = threading.Event()
+        release = threading.Event()
+        def update_database():
+            running.set()
+            release.wait(5)
+            build.update()
+        graph.update_database.side_effect = update_database
+        # Act
+        scheduler.start()
+        first = scheduler.request()
+        running.wait(5)
+        second = scheduler.request()
+        third = scheduler.request(force=True)
+        release.set()
+        deadline = time.monotonic() + 5
+        while (scheduler.get_status(second['id']) or {}).get('state') != 'done' and time.monotonic() < deadline:
+            time.sleep(0.05)
+        first_status = scheduler.get_status(first['id'])
+        second_status = scheduler.get_status(second['id'])
+        # Assert
+        self.assertEqual(graph.update_database.call_count, 2)
+        self.assertNotEqual(first['id'], second['id'])
+        self.assertEqual(second['id'], third['id'])
+        self.assertEqual(second_status['requests'], 2)
+        self.assertTrue(second_status['force'])
+        self.assertEqual(first_status['state'], 'done')
+        self.assertEqual(first_status['version'], 1)
+        self.assertEqual(second_status['version'], 2)
+        self.assertEqual([p['name'] for p in second_status['phases']], ['collect', 'endpoints', 'nodes', 'publish'])
+        self.assertEqual(second_status['phases'][2]['done'], 1)
+        self.assertEqual(second_status['phases'][2]['total'], 1)
+        self.assertEqual(scheduler.get_status()['id'], second['id'])
+
+    def test_refresh_scheduler_startup_retry(self):
+        """Test that a refresh that does not publish a topology fails and is retried until one is published"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        apic_ip = build.env.apic_ip
+        graph = MagicMock()
+        scheduler = VkaciRefreshScheduler(graph, build, retry_delay=0.01)
+        def update_database():
+            # The first refresh returns early without APIC IP, the second one fails, the third one publishes
+            calls = graph.update_database.call_count
+            build.env.apic_ip = [] if calls == 1 else apic_ip
+            if calls == 2:
+                raise Exception("APIC unreachable")
+            build.update()
+        graph.update_database.side_effect = update_database
+        # Act
+        scheduler.start()
+        first = scheduler.request(reason="startup")
+        deadline = time.monotonic() + 5
+        while build.get_snapshot().version == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        while (scheduler.get_status() or {}).get('state') != 'done' and time.monotonic() < deadline:
+            time.sleep(0.05)
+        jobs = [scheduler.get_status(first['id'] + i) for i in range(3)]
+        # Assert
+        self.assertEqual(graph.update_database.call_count, 3)
+        self.assertEqual([job['reason'] for job in jobs], ['startup', 'retry', 'retry'])
+        self.assertEqual([job['state'] for job in jobs], ['failed', 'failed', 'done'])
+        self.assertEqual(jobs[0]['error'], "The refresh did not publish a topology")
+        self.assertEqual(jobs[1]['error'], "APIC unreachable")
+        self.assertEqual(jobs[2]['version'], 1)
+        self.assertEqual(scheduler.retries, 0)
+        self.assertIsNone(scheduler.retry_at)
+
+    @patch('app.graph.Graph')
+    def test_graph_incremental_sync(self, graph_class):
+        """Test that the schema is created and the graph fully loaded once, only the changes are written afterwards"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        graph = VkaciGraph(build.env, build)
+        neo4j = graph_class.return_value
+        tx = neo4j.begin.return_value
+        # Act
+        graph.update_database()
+        schema_queries = [c.args[0] for c in neo4j.run.call_args_list]
+        full_queries = [c.args[0] for c in tx.run.call_args_list]
+        tx.run.reset_mock()
+        graph.update_database()
+        unchanged_queries = [c.args[0] for c in tx.run.call_args_list]
+        graph.invalidate()
+        graph.update_database()
+        # Assert
+        graph_class.assert_called_once()
+        self.assertEqual(schema_queries, VkaciGraph.schema)
+        self.assertEqual(full_queries[0], "MATCH (n) DETACH DELETE n")
+        self.assertIn(VkaciGraph.query, full_queries)
+        self.assertEqual(unchanged_queries, [])
+        self.assertEqual(tx.run.call_args_list[0].args[0], "MATCH (n) DETACH DELETE n")
+        self.assertEqual(neo4j.run.call_count, 2 * len(VkaciGraph.schema))
+        self.assertEqual(neo4j.commit.call_count, 3)
+
+    @patch('app.graph.Graph')
+    def test_graph_per_batch_reload(self, graph_class):
+        """Test that without a single transaction the full reload wipes the graph in batches and BLUE_GREEN commits per batch by default"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        graph = VkaciGraph(VkaciEnvVariables({**self.vars, "NEO4J_SINGLE_TRANSACTION": "False", "NEO4J_BATCH_SIZE": "2"}), build)
+        neo4j = graph_class.return_value
+        neo4j.evaluate.side_effect = [2, 2, 1]
+        # Act
+        graph.update_database()
+        # Assert
+        neo4j.begin.assert_not_called()
+        self.assertEqual(neo4j.evaluate.call_count, 3)
+        neo4j.evaluate.assert_called_with(VkaciGraph.wipe_query, limit=2)
+        self.assertNotIn("MATCH (n) DETACH DELETE n", [c.args[0] for c in neo4j.run.call_args_list])
+        self.assertIn(VkaciGraph.query, [c.args[0] for c in neo4j.run.call_args_list])
+        self.assertTrue(VkaciEnvVariables(self.vars).neo4j_single_transaction)
+        self.assertFalse(VkaciEnvVariables({**self.vars, "NEO4J_PUBLICATION": "BLUE_GREEN"}).neo4j_single_transaction)
+
+    @patch('app.graph.time.sleep', MagicMock(return_value=None))
+    @patch('app.graph.Graph')
+    def test_graph_write_retry(self, graph_class):
+        """Test that a write failing with a transient error is rolled back and retried"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        graph = VkaciGraph(build.env, build)
+        neo4j = graph_class.return_value
+        tx = neo4j.begin.return_value
+        tx.run.side_effect = [TransientError("deadlock", "Neo.TransientError.Transaction.DeadlockDetected")] + [MagicMock()] * 20
+        # Act
+        graph.update_database()
+        # Assert
+        neo4j.rollback.assert_called_once_with(tx)
+        neo4j.commit.assert_called_once_with(tx)
+        self.assertEqual(neo4j.begin.call_count, 2)
+        self.assertIsNotNone(graph.written)
+
+    @patch('app.graph.Graph')
+    def test_graph_schema_errors(self, graph_class):
+        """Test that the graph is only wiped when a constraint cannot be created on the existing data"""
+        # Arrange
+        graph = VkaciGraph(VkaciEnvVariables(self.vars), None)
+        neo4j = graph_class.return_value
+        duplicates = ClientError("duplicates", "Neo.ClientError.Schema.ConstraintCreationFailed")
+        denied = ClientError("denied", "Neo.ClientError.Security.Forbidden")
+        # Act
+        neo4j.run.side_effect = [duplicates] + [MagicMock()] * 20
+        graph.create_schema(neo4j)
+        wiped = [c.args[0] for c in neo4j.run.call_args_list]
+        graph.invalidate()
+        neo4j.run.reset_mock()
+        neo4j.run.side_effect = [denied] + [MagicMock()] * 20
+        # Assert
+        self.assertIn("MATCH (n) DETACH DELETE n", wiped)
+        self.assertFalse(graph.schema_ready)
+        with self.assertRaises(ClientError):
+            graph.create_schema(neo4j)
+        self.assertNotIn("MATCH (n) DETACH DELETE n", [c.args[0] for c in neo4j.run.call_args_list])
+
+    @patch('app.graph.time.sleep', MagicMock(return_value=None))
+    @patch('app.graph.Graph')
+    def test_graph_schema_after_connection_error(self, graph_class):
+        """Test that the schema is created again after a connection error"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        graph = VkaciGraph(build.env, build)
+        neo4j = graph_class.return_value
+        tx = neo4j.begin.return_value
+        graph.update_database()
+        graph.written = None
+        neo4j.run.reset_mock()
+        tx.run.side_effect = [ConnectionBroken("reset")] + [MagicMock()] * 20
+        # Act
+        graph.update_database()
+        # Assert
+        self.assertEqual([c.args[0] for c in neo4j.run.call_args_list], VkaciGraph.schema)
+        self.assertTrue(graph.schema_ready)
+
+    def test_graph_dirty_nodes(self):
+        """Test that a changed node and the nodes sharing its VM host are rewritten"""
+        # Arrange
+        def item(name, host, pods):
+            return {"node_name": name, "node_ip": "", "node_mac": None, "labels": [], "bgp_peers": [],
+                    "vm_hosts": [{"host_name": host, "description": "Hypervisor"}],
+                    "pods": [{"name": p, "ip": "", "ns": "default", "labels": [], "annotations": [], "primary_iface": ""} for p in pods]}
+        switch_data = {"items": [{"name": "leaf-101", "nodes": [], "vm_hosts": [
+            {"name": "esxi1", "interface": "eth1/1", "switch_name": "leaf-101", "node": "node-1"},
+            {"name": "esxi1", "interface": "eth1/1", "switch_name": "leaf-101", "node": "node-2"},
+            {"name": "esxi2", "interface": "eth1/2", "switch_name": "leaf-101", "node": "node-3"}]}]}
+        old = VkaciGraph.graph_footprints({"items": [item("node-1", "esxi1", ["a"]), item("node-2", "esxi1", ["b"]), item("node-3", "esxi2", ["c"])]}, switch_data)
+        new = VkaciGraph.graph_footprints({"items": [item("node-1", "esxi1", ["a", "d"]), item("node-2", "esxi1", ["b"]), item("node-3", "esxi2", ["c"])]}, switch_data)
+        graph = VkaciGraph(VkaciEnvVariables(self.vars), None)
+        # Act
+        unchanged = graph.dirty_nodes(old, old)
+        dirty = graph.dirty_nodes(old, new)
+        data, filtered = graph.filter_graph_data(new, dirty, {"leaf-101": 0})
+        # Assert
+        self.assertEqual(unchanged, set())
+        self.assertEqual(dirty, {"node-1", "node-2"})
+        self.assertEqual(sorted(n["node_name"] for n in data["items"]), ["node-1", "node-2"])
+        self.assertEqual(sorted(v["node"] for v in filtered["items"][0]["vm_hosts"]), ["node-1", "node-2"])
+
+    def test_graph_batches(self):
+        """Test that the graph data is written in batches of NEO4J_BATCH_SIZE nodes"""
+        # Arrange
+        graph = VkaciGraph(VkaciEnvVariables({**self.vars, "NEO4J_BATCH_SIZE": "2"}), MagicMock())
+        neo4j = MagicMock()
+        nodes = [{"node_name": "node-%s" % i} for i in range(5)]
+        switch = {"name": "leaf-101", "vm_hosts": [], "nodes": [{"name": "node-%s" % i, "interface": "eth1/%s" % i, "switch_name": "leaf-101"} for i in range(3)]}
+        # Act
+        data = graph.batches(nodes, lambda n: 1)
+        switch_data = graph.batches(graph.split_switch_items([switch]), lambda s: len(s["nodes"]) + len(s["vm_hosts"]))
+        graph.run_batched(neo4j, "query", data, 0)
+        # Assert
+        self.assertEqual([rows for _, rows in data], [2, 2, 1])
+        self.assertEqual([rows for _, rows in switch_data], [2, 1])
+        self.assertEqual([b["items"][0]["node_count"] for b, _ in switch_data], [3, 3])
+        self.assertEqual(neo4j.run.call_count, 3)
+        self.assertEqual(neo4j.run.call_args_list[2].kwargs, {"json": {"items": [{"node_name": "node-4"}]}, "generation": 0})
+        graph.topology.report.assert_called_with('neo4j', query="query", rows=5)
+
+    @patch('app.graph.Graph')
+    def test_graph_blue_green(self, graph_class):
+        """Test that a refresh is written as a new generation, published, and the old generations deleted"""
+        # Arrange
+        build = VkaciBuilTopology(
+            VkaciEnvVariables(self.vars), ApicMethodsMock())
+        graph = VkaciGraph(VkaciEnvVariables({**self.vars, "NEO4J_PUBLICATION": "BLUE_GREEN", "NEO4J_SINGLE_TRANSACTION": "True"}), build)
+        neo4j = graph_class.return_value
+        tx = neo4j.begin.return_value
+        neo4j.evaluate.side_effect = lambda query, **kwargs: 3 if query == VkaciGraph.current_generation_query else 0
+        # Act
+        graph.update_database()
+        collector = graph.collector
+        if collector is not None:
+            collector.join(5)
+        # Assert
+        self.assertEqual([c.args[0] for c in neo4j.run.call_args_list if c.args[0] != VkaciGraph.publish_query], VkaciGraph.blue_green_schema)
+        neo4j.run.assert_called_with(VkaciGraph.publish_query, generation=4)
+        self.assertNotIn("MATCH (n) DETACH DELETE n", [c.args[0] for c in tx.run.call_args_list])
+        self.assertTrue(all(c.kwargs["generation"] == 4 for c in tx.run.call_args_list))
+        neo4j.commit.assert_called_once_with(tx)
+        for label in VkaciGraph.generation_labels:
+            neo4j.evaluate.assert_any_call(VkaciGraph.newer_generations_query.format(label=label), generation=3, limit=1000)
+            neo4j.evaluate.assert_any_call(VkaciGraph.older_generations_query.format(label=label), generation=4, limit=1000)
+            neo4j.evaluate.assert_any_call(VkaciGraph.untagged_query.format(label=label), generation=4, limit=1000)
+        self.assertNotIn("MATCH (n)", "".join(c.args[0] for c in neo4j.evaluate.call_args_list))
+        self.assertEqual(graph.generation, 4)
+        self.assertIsNone(graph.collector)
+
 if __name__ == '__main__':
     unittest.main()